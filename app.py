@@ -7,15 +7,20 @@ import pandas as pd
 from dotenv import load_dotenv
 
 from tullkod_model import (
+    cache_key,
     classify_product,
-    add_tullkod_column,
     explain_classification,
+    iter_tullkod_column,
 )
 
 # --------------------------------------------------------------------
 # BASIC SETUP
 # --------------------------------------------------------------------
 load_dotenv()
+
+# Lets df.assign() share the uploaded columns instead of deep-copying them
+pd.set_option("mode.copy_on_write", True)
+
 APP_USERNAME = os.getenv("APP_USERNAME")
 APP_PASSWORD = os.getenv("APP_PASSWORD")
 
@@ -25,6 +30,56 @@ st.set_page_config(
     layout="wide",
 )
 
+# --------------------------------------------------------------------
+# CACHED MODEL CALLS
+# --------------------------------------------------------------------
+# Arguments prefixed with "_" are not hashed by Streamlit, so the cache is
+# keyed only on the normalized tuple while the model still sees the raw text.
+@st.cache_data(show_spinner=False, max_entries=10_000)
+def cached_classify(key: tuple, _name: str, _desc: str, _comp: str) -> str:
+    return classify_product(
+        product_name=_name,
+        product_description=_desc,
+        composition=_comp,
+    )
+
+
+@st.cache_data(show_spinner=False, max_entries=10_000)
+def cached_explain(
+    key: tuple, tullkod: str, _name: str, _desc: str, _comp: str
+) -> str:
+    return explain_classification(
+        product_name=_name,
+        product_description=_desc,
+        composition=_comp,
+        tullkod=tullkod,
+    )
+
+
+PREVIEW_ROWS = 200
+
+
+@st.cache_data(show_spinner=False, max_entries=20)
+def read_preview(data: bytes) -> pd.DataFrame:
+    """First rows of an uploaded .xlsx, enough for the preview and column picker."""
+    return pd.read_excel(io.BytesIO(data), engine="calamine", nrows=PREVIEW_ROWS)
+
+
+@st.cache_data(show_spinner=False, max_entries=20)
+def read_upload(data: bytes, text_cols: tuple) -> pd.DataFrame:
+    """
+    Parse a whole uploaded .xlsx once per file content (Rust-backed calamine reader).
+
+    `text_cols` are read as strings, skipping type inference for the columns
+    sent to the model; all other columns keep their types for the download.
+    """
+    return pd.read_excel(
+        io.BytesIO(data),
+        engine="calamine",
+        dtype={col: str for col in text_cols},
+    )
+
+
 # --------------------------------------------------------------------
 # GLOBAL STYLING (LIGHT BABY-BLUE THEME)
 # --------------------------------------------------------------------
@@ -306,21 +361,23 @@ with tab_single:
             st.warning("Fill in at least one field before generating.")
         else:
             with st.spinner("Classifying product..."):
-                tullkod = classify_product(
-                    product_name=product_name,
-                    product_description=product_description,
-                    composition=composition,
+                tullkod = cached_classify(
+                    cache_key(product_name, product_description, composition),
+                    product_name,
+                    product_description,
+                    composition,
                 )
 
             st.success(f"Customs code: **{tullkod}**")
 
             # AI explanation
             with st.spinner("Explaining the classification..."):
-                explanation = explain_classification(
-                    product_name=product_name,
-                    product_description=product_description,
-                    composition=composition,
-                    tullkod=tullkod,
+                explanation = cached_explain(
+                    cache_key(product_name, product_description, composition),
+                    tullkod,
+                    product_name,
+                    product_description,
+                    composition,
                 )
 
             if tullkod != "UNKNOWN":
@@ -366,7 +423,7 @@ with tab_bulk:
     )
 
     if uploaded_file is not None:
-        df = pd.read_excel(uploaded_file)
+        df = read_preview(uploaded_file.getvalue())
 
         st.markdown("#### Data preview")
         st.dataframe(df.head())
@@ -397,26 +454,79 @@ with tab_bulk:
                 index=comp_default,
             )
 
+            # Results survive reruns (Stop, download) for this file and columns
+            result_key = (uploaded_file.file_id, name_col, desc_col, comp_col)
+
             if st.button("Generate customs codes for all records", type="primary"):
-                with st.spinner("Classifying all products..."):
-                    result_df = add_tullkod_column(
-                        df.copy(),
-                        name_col=name_col,
-                        desc_col=desc_col,
-                        comp_col=comp_col,
-                        output_col="Customs code",
+                full_df = read_upload(
+                    uploaded_file.getvalue(),
+                    text_cols=tuple(dict.fromkeys([name_col, desc_col, comp_col])),
+                )
+
+                st.session_state["bulk_result"] = None
+                running = st.empty()
+
+                with running.container():
+                    st.markdown("#### Results with customs code")
+
+                    # Any widget interaction reruns the script, which stops this
+                    # run; the rows classified so far are kept in session_state
+                    st.button("Stop classification")
+
+                    progress = st.progress(0.0, text="Classifying all products...")
+                    table = st.empty()
+
+                def _on_progress(done: int, total: int) -> None:
+                    progress.progress(
+                        done / total if total else 1.0,
+                        text=f"Classifying all products... ({done}/{total})",
                     )
 
-                st.success("Classification is completed!")
-                st.markdown("#### Preview with customs code")
-                st.dataframe(result_df.head())
+                # Rows show up as soon as their chunk is classified
+                for result_df in iter_tullkod_column(
+                    full_df,
+                    name_col=name_col,
+                    desc_col=desc_col,
+                    comp_col=comp_col,
+                    output_col="Customs code",
+                    on_progress=_on_progress,
+                ):
+                    st.session_state["bulk_result"] = {
+                        "key": result_key,
+                        "df": result_df,
+                        "complete": False,
+                    }
+                    table.dataframe(result_df)
+
+                st.session_state["bulk_result"]["complete"] = True
+                running.empty()
+
+            bulk_result = st.session_state.get("bulk_result")
+            if bulk_result and bulk_result["key"] == result_key:
+                result_df = bulk_result["df"]
+
+                if bulk_result["complete"]:
+                    st.success("Classification is completed!")
+                else:
+                    st.warning(
+                        "Classification was stopped. Rows without a customs code "
+                        "were not classified yet."
+                    )
+
+                st.markdown("#### Results with customs code")
+                st.dataframe(result_df)
 
                 buffer = io.BytesIO()
-                result_df.to_excel(buffer, index=False)
+                with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
+                    result_df.to_excel(writer, index=False)
                 buffer.seek(0)
 
                 st.download_button(
-                    label="Download the results (Excel)",
+                    label=(
+                        "Download the results (Excel)"
+                        if bulk_result["complete"]
+                        else "Download the partial results (Excel)"
+                    ),
                     data=buffer,
                     file_name="tullkoder_resultat.xlsx",
                     mime=(
@@ -1,15 +1,19 @@
 # tullkod_model.py
-import json
 import re
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import Optional
+from typing import TYPE_CHECKING, Callable, Iterator, NamedTuple, Optional
 
+import numpy as np
+import orjson
 import pandas as pd
+import streamlit as st
 from dotenv import load_dotenv
 
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser
-from langchain_openai import ChatOpenAI
+if TYPE_CHECKING:
+    from langchain_core.runnables import Runnable
 
 # ---------------------------------------------------------------------
 # ENV + TARIC JSON
@@ -19,14 +23,52 @@ load_dotenv()
 BASE_DIR = Path(__file__).resolve().parent
 TARIC_JSON_PATH = BASE_DIR / "taric_30.json"
 
-with open(TARIC_JSON_PATH, encoding="utf-8") as f:
-    taric_data = json.load(f)
 
-# JSON as string passed to the model
-taric_text = json.dumps(taric_data, ensure_ascii=False)
+@st.cache_resource
+def _load_taric() -> tuple[dict, str]:
+    """Parse the TARIC JSON once per process and share it across sessions."""
+    data = orjson.loads(TARIC_JSON_PATH.read_bytes())
+    # JSON as string passed to the model (orjson emits compact UTF-8)
+    return data, orjson.dumps(data).decode("utf-8")
+
+
+taric_data, taric_text = _load_taric()
+
+
+def walk_taric(node: dict) -> Iterator[dict]:
+    """Yield every node of the TARIC hierarchy, depth first."""
+    yield node
+    for child in node.get("children", []):
+        yield from walk_taric(child)
+
+
+# All codes present in the JSON (any level)
+VALID_CODES = frozenset(node["code"] for node in walk_taric(taric_data))
+
+
+def _build_code_index(node: dict, path: tuple = ()) -> dict[str, dict]:
+    """Map each code to its own description plus the headings above it."""
+    index = {
+        node["code"]: {
+            "code": node["code"],
+            "description": node["description"],
+            "path": list(path),
+        }
+    }
+    parent = path + ({"code": node["code"], "description": node["description"]},)
+    for child in node.get("children", []):
+        index.update(_build_code_index(child, parent))
+    return index
+
+
+# Compact per-code context for the explanation prompt
+CODE_INDEX = _build_code_index(taric_data)
+
+# Braces escaped so the JSON can sit inside a prompt template verbatim
+_taric_prompt_text = taric_text.replace("{", "{{").replace("}", "}}")
 
 # ---------------------------------------------------------------------
-# CLASSIFICATION CHAIN (returns a code as text)
+# CLASSIFICATION PROMPT (the model returns a code as text)
 # ---------------------------------------------------------------------
 system_prompt = """
 You are a customs classification assistant.
@@ -44,35 +86,40 @@ Task:
 - If the JSON does not contain a 10-digit match, return the closest most specific code found in the JSON
   (prefer 10 digits; otherwise 8, 6, 4, 2).
 - If the product cannot be classified within Chapter 30, return: UNKNOWN.
+- Candidate codes from a keyword match may be given as a hint; they can be wrong, so verify them against the JSON.
 - Important: Never output descriptions or explanations, just the code (or UNKNOWN).
 """
 
-prompt = ChatPromptTemplate.from_messages(
-    [
-        ("system", system_prompt),
-        (
-            "user",
-            "JSON:\n{json}\n\n"
-            "Produktnamn: {name}\n"
-            "Produktbeskrivning: {desc}\n"
-            "Produktsammansättning / substanser: {composition}"
-        ),
-    ]
+# The TARIC JSON lives in the system message so every request shares an
+# identical prefix, which lets the provider reuse its prompt cache.
+system_prompt_full = system_prompt + "\n\nTARIC JSON:\n" + _taric_prompt_text
+
+user_prompt = (
+    "Produktnamn: {name}\n"
+    "Produktbeskrivning: {desc}\n"
+    "Produktsammansättning / substanser: {composition}\n"
+    "Kandidatkoder från ordmatchning: {hint}"
 )
 
-parser = StrOutputParser()
+# Routes requests with the same static prefix to the same cache on OpenAI's
+# side. Bump the version whenever the prompt or the TARIC JSON changes.
+PROMPT_CACHE_KEY = "taric_chapter_30_v2"
 
-llm = ChatOpenAI(
-    model="gpt-5.2",
-    temperature=0,
-)
+# Max number of parallel LLM requests when classifying a whole dataframe
+BATCH_MAX_CONCURRENCY = 16
 
-classification_chain = prompt | llm | parser
+# Finished unique products between two partial results of a bulk run
+BATCH_CHUNK_SIZE = 32
 
 
 # ---------------------------------------------------------------------
 # NORMALIZATION: enforce digits-only / UNKNOWN
 # ---------------------------------------------------------------------
+_NON_DIGIT = re.compile(r"\D+")
+_TEN_DIGIT = re.compile(r"\b\d{10}\b")
+_VALID_LENS = frozenset((10, 8, 6, 4, 2))
+
+
 def normalize_code(text: Optional[str]) -> str:
     """
     Normalize the model output into a clean TARIC code or 'UNKNOWN'.
@@ -85,18 +132,17 @@ def normalize_code(text: Optional[str]) -> str:
         return "UNKNOWN"
 
     # Keep only digits
-    digits = re.sub(r"\D+", "", text)
+    digits = _NON_DIGIT.sub("", text)
 
     if not digits:
         return "UNKNOWN"
 
     # Accept typical TARIC lengths directly
-    for k in (10, 8, 6, 4, 2):
-        if len(digits) == k:
-            return digits
+    if len(digits) in _VALID_LENS:
+        return digits
 
     # Try to find a 10-digit sequence in the raw text
-    m = re.search(r"\b\d{10}\b", text)
+    m = _TEN_DIGIT.search(text)
     if m:
         return m.group(0)
 
@@ -105,13 +151,160 @@ def normalize_code(text: Optional[str]) -> str:
 
 
 # ---------------------------------------------------------------------
-# EXPLANATION CHAIN (short reasoning text in Swedish)
+# FAST PATH: the input already contains a known code
+# ---------------------------------------------------------------------
+# 4- and 2-digit numbers are too often pack sizes / strengths to trust
+_PASTED_CODE = re.compile(r"\b(?:\d{10}|\d{8}|\d{6})\b")
+
+
+def find_pasted_code(*texts: Optional[str]) -> Optional[str]:
+    """
+    Return the most specific TARIC code from `VALID_CODES` written verbatim in
+    any of the texts, or None if there is no such code.
+    """
+    text = " ".join(t for t in texts if t)
+    found = [c for c in _PASTED_CODE.findall(text) if c in VALID_CODES]
+    return max(found, key=len) if found else None
+
+
+# At least one word of two or more letters (any alphabet)
+_WORD = re.compile(r"[^\W\d_]{2,}")
+
+
+def has_product_text(*texts: Optional[str]) -> bool:
+    """
+    False for inputs the LLM cannot classify anyway: blank cells, or only numbers
+    and punctuation (e.g. empty rows or stray quantities in an Excel sheet).
+    """
+    return any(_WORD.search(t) for t in texts if t)
+
+
+# ---------------------------------------------------------------------
+# LOCAL MATCH: token index over the 10-digit TARIC descriptions
+# ---------------------------------------------------------------------
+_TOKEN = re.compile(r"[^\W\d_]{4,}")
+
+# Function words that only make sense together with the parent heading
+_STOPWORDS = frozenset(
+    {
+        "andra", "bruk", "dessa", "detta", "från", "inte",
+        "samt", "slag", "till", "varor", "även", "ämnen",
+    }
+)
+
+# Tokens found in more leaf descriptions than this ("andra", "innehållande",
+# ...) say nothing about which leaf is meant and are left out of the index
+_MAX_TOKEN_LEAVES = 4
+
+# A leaf is only picked without the LLM if all of its (at least three)
+# distinctive tokens occur in the input and no other leaf scores as high;
+# shorter matches are too easy to hit by accident and only serve as hints
+LOCAL_MATCH_MIN_SCORE = 1.0
+LOCAL_MATCH_MIN_TOKENS = 3
+
+# Bulk (3003) vs doses / retail packs (3004) is decided by the heading, not
+# by the leaf wording, so leaves under these headings are hints only
+_HINT_ONLY_HEADINGS = ("3003", "3004")
+
+
+def _tokens(text: str) -> set[str]:
+    return set(_TOKEN.findall(text.lower())) - _STOPWORDS
+
+
+def _build_token_index() -> tuple[dict[str, frozenset], dict[str, set[str]]]:
+    leaf_tokens = {
+        node["code"]: _tokens(node["description"])
+        for node in walk_taric(taric_data)
+        if len(node["code"]) == 10
+    }
+    leaves_per_token = Counter(t for toks in leaf_tokens.values() for t in toks)
+
+    code_tokens = {}
+    index = {}
+    for code, toks in leaf_tokens.items():
+        distinctive = frozenset(
+            t for t in toks if leaves_per_token[t] <= _MAX_TOKEN_LEAVES
+        )
+        if not distinctive:
+            continue
+        code_tokens[code] = distinctive
+        for t in distinctive:
+            index.setdefault(t, set()).add(code)
+    return code_tokens, index
+
+
+# code -> distinctive description tokens, token -> codes containing it
+CODE_TOKENS, TOKEN_INDEX = _build_token_index()
+
+
+def match_candidates(*texts: Optional[str]) -> list[tuple[float, str]]:
+    """
+    Score 10-digit codes by the share of their distinctive description tokens
+    found in the texts. Returns (score, code) pairs, best first.
+    """
+    tokens = _tokens(" ".join(t for t in texts if t))
+    codes = set().union(*(TOKEN_INDEX.get(t, ()) for t in tokens))
+    scored = [(len(CODE_TOKENS[c] & tokens) / len(CODE_TOKENS[c]), c) for c in codes]
+    return sorted(scored, reverse=True)
+
+
+def _local_match(candidates: list[tuple[float, str]]) -> Optional[str]:
+    if not candidates:
+        return None
+    score, code = candidates[0]
+    if score < LOCAL_MATCH_MIN_SCORE or len(CODE_TOKENS[code]) < LOCAL_MATCH_MIN_TOKENS:
+        return None
+    if code.startswith(_HINT_ONLY_HEADINGS):
+        return None
+    # Equally good matches elsewhere: let the LLM decide
+    if len(candidates) > 1 and candidates[1][0] == score:
+        return None
+    # A partially matched, more specific sibling (e.g. "kulturer av
+    # mikroorganismer – patogener" vs "– andra") also needs the LLM
+    if any(CODE_TOKENS[code] < CODE_TOKENS[c] for _, c in candidates[1:]):
+        return None
+    return code
+
+
+def _hint(candidates: list[tuple[float, str]], limit: int = 3) -> str:
+    """Top keyword matches as a hint for the LLM prompt."""
+    best = [code for score, code in candidates[:limit] if score >= 0.5]
+    return ", ".join(best) if best else "-"
+
+
+def _triage(
+    name: str, desc: str, composition: str
+) -> tuple[Optional[str], Optional[dict]]:
+    """
+    Either `(code, None)` for inputs that need no LLM call, or `(None, prompt_input)`
+    with the keyword matches as a hint when the LLM must decide.
+    """
+    pasted = find_pasted_code(name, desc, composition)
+    if pasted:
+        return pasted, None
+    if not has_product_text(name, desc, composition):
+        return "UNKNOWN", None
+
+    candidates = match_candidates(name, desc, composition)
+    local = _local_match(candidates)
+    if local:
+        return local, None
+    return None, {
+        "name": name,
+        "desc": desc,
+        "composition": composition,
+        "hint": _hint(candidates),
+    }
+
+
+# ---------------------------------------------------------------------
+# EXPLANATION PROMPT (short reasoning text in Swedish)
 # ---------------------------------------------------------------------
 explanation_system_prompt = """
 Du är en tullklassificeringsassistent.
 
 Du får:
-- TARIC-hierarkin för kapitel 30 som JSON
+- TARIC-posten för den valda koden (med överordnade rubriker i `path`) som JSON
 - Ett produktnamn, en produktbeskrivning, en sammansättning
 - Den valda tullkoden (endast siffror eller UNKNOWN)
 
@@ -123,48 +316,238 @@ Uppgift:
 - Om koden är UNKNOWN, förklara kort att produkten inte kan klassificeras i kapitel 30 utifrån uppgifterna.
 """
 
-explanation_prompt = ChatPromptTemplate.from_messages(
-    [
-        ("system", explanation_system_prompt),
-        (
-            "user",
-            "JSON:\n{json}\n\n"
-            "Vald tullkod: {code}\n\n"
-            "Produktnamn: {name}\n"
-            "Produktbeskrivning: {desc}\n"
-            "Produktsammansättning / substanser: {composition}"
-        ),
-    ]
+explanation_user_prompt = (
+    "JSON:\n{json}\n\n"
+    "Vald tullkod: {code}\n\n"
+    "Produktnamn: {name}\n"
+    "Produktbeskrivning: {desc}\n"
+    "Produktsammansättning / substanser: {composition}"
 )
 
-explanation_llm = ChatOpenAI(
-    model="gpt-4o-mini",
-    temperature=0.0,
-)
 
-explanation_chain = explanation_prompt | explanation_llm | parser
+# ---------------------------------------------------------------------
+# LLM CHAINS (built on first use, shared across sessions)
+# ---------------------------------------------------------------------
+class Chains(NamedTuple):
+    fast_classification: "Runnable"
+    classification: "Runnable"
+    explanation: "Runnable"
+
+
+@st.cache_resource
+def get_chains() -> Chains:
+    """
+    Build the LangChain chains once per process.
+
+    LangChain is imported here rather than at module level so the login page
+    renders without paying for the import.
+    """
+    from langchain_core.output_parsers import StrOutputParser
+    from langchain_core.prompts import ChatPromptTemplate
+    from langchain_openai import ChatOpenAI
+
+    parser = StrOutputParser()
+
+    prompt = ChatPromptTemplate.from_messages(
+        [("system", system_prompt_full), ("user", user_prompt)]
+    )
+
+    # Small/fast model tried first; the large model is only used when the
+    # fast answer is UNKNOWN or not a code from the JSON.
+    fast_llm = ChatOpenAI(
+        model="gpt-4o-mini",
+        temperature=0,
+        extra_body={"prompt_cache_key": f"{PROMPT_CACHE_KEY}_classify_fast"},
+    )
+
+    llm = ChatOpenAI(
+        model="gpt-5.2",
+        temperature=0,
+        extra_body={"prompt_cache_key": f"{PROMPT_CACHE_KEY}_classify"},
+    )
+
+    explanation_prompt = ChatPromptTemplate.from_messages(
+        [("system", explanation_system_prompt), ("user", explanation_user_prompt)]
+    )
+
+    explanation_llm = ChatOpenAI(
+        model="gpt-4o-mini",
+        temperature=0.0,
+    )
+
+    return Chains(
+        fast_classification=prompt | fast_llm | parser,
+        classification=prompt | llm | parser,
+        explanation=explanation_prompt | explanation_llm | parser,
+    )
 
 
 # ---------------------------------------------------------------------
 # PUBLIC API FUNCTIONS
 # ---------------------------------------------------------------------
+def _text(value: Optional[object]) -> str:
+    """Model input text for a possibly missing value."""
+    return "" if value is None else str(value)
+
+
+def cache_key(*values: Optional[str]) -> tuple:
+    """Case- and whitespace-insensitive key so trivial variants share a cache entry."""
+    return tuple(" ".join((v or "").lower().split()) for v in values)
+
+
+# Codes from earlier bulk runs, shared by all sessions of this process so
+# re-running the same (or an overlapping) upload needs no new LLM calls
+CODE_CACHE_MAX_ENTRIES = 10_000
+_code_cache: dict[tuple, str] = {}
+# Sessions run in separate threads; eviction iterates the dict
+_code_cache_lock = threading.Lock()
+
+
+def _remember_code(key: tuple, code: str) -> None:
+    with _code_cache_lock:
+        if key not in _code_cache and len(_code_cache) >= CODE_CACHE_MAX_ENTRIES:
+            # dicts keep insertion order: drop the oldest entry
+            del _code_cache[next(iter(_code_cache))]
+        _code_cache[key] = code
+
+
+def _classify_input(chains: Chains, prompt_input: dict) -> str:
+    """
+    Classify with the fast model; re-run with the large model only if the answer
+    is unresolved (UNKNOWN or not in `VALID_CODES`).
+    """
+    code = normalize_code(chains.fast_classification.invoke(prompt_input))
+    if code not in VALID_CODES:
+        code = normalize_code(chains.classification.invoke(prompt_input))
+    return code
+
+
+def _iter_classified(inputs: list[dict]) -> Iterator[tuple[int, str]]:
+    """
+    Classify all inputs concurrently and yield `(index, code)` as each one is
+    finished, so a slow retry never holds back the rest.
+    """
+    chains = get_chains()
+    executor = ThreadPoolExecutor(max_workers=BATCH_MAX_CONCURRENCY)
+    try:
+        futures = {
+            executor.submit(_classify_input, chains, prompt_input): i
+            for i, prompt_input in enumerate(inputs)
+        }
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        # If the caller stops early (e.g. the user pressed Stop), drop the
+        # queued requests instead of waiting for them
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _classify_inputs(inputs: list[dict]) -> list[str]:
+    codes = [""] * len(inputs)
+    for i, code in _iter_classified(inputs):
+        codes[i] = code
+    return codes
+
+
 def classify_product(
     product_name: str,
     product_description: str,
     composition: str,
 ) -> str:
     """
-    Call the LLM once for a single product and return a clean TARIC code (or 'UNKNOWN').
+    Classify a single product with the LLM and return a clean TARIC code (or 'UNKNOWN').
+
+    No LLM call is made if the input already contains a known code, contains no
+    words at all ('UNKNOWN'), or unambiguously matches a TARIC description.
     """
-    raw = classification_chain.invoke(
-        {
-            "json": taric_text,
-            "name": product_name or "",
-            "desc": product_description or "",
-            "composition": composition or "",
-        }
-    )
-    return normalize_code(raw)
+    name, desc, comp = _text(product_name), _text(product_description), _text(composition)
+
+    quick, prompt_input = _triage(name, desc, comp)
+    if quick:
+        return quick
+
+    [code] = _classify_inputs([prompt_input])
+    return code
+
+
+def iter_tullkod_column(
+    df: pd.DataFrame,
+    name_col: str,
+    desc_col: str,
+    comp_col: str,
+    output_col: str = "Tullkod",
+    chunk_size: int = BATCH_CHUNK_SIZE,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+) -> Iterator[pd.DataFrame]:
+    """
+    Like `add_tullkod_column`, but yields the dataframe each time another
+    `chunk_size` unique products are finished so results can be shown while
+    the rest runs.
+
+    Rows that are not classified yet have None in `output_col`; the last
+    yielded dataframe is complete. `df` itself is not modified.
+    `on_progress(done, total)` is called after every finished unique product.
+    """
+    # The same column may be picked for several fields
+    key_cols = list(dict.fromkeys([name_col, desc_col, comp_col]))
+    # Vectorized coercion; empty cells become "" rather than "nan"
+    keys = df[key_cols].fillna("").astype(str)
+
+    # Same normalization as `cache_key`, so case / whitespace variants count
+    # as one product
+    norm = keys.apply(lambda col: col.str.lower().str.split().str.join(" "))
+
+    # Only classify each distinct normalized (name, desc, composition) once,
+    # sending the first-seen spelling to the model; both the rows of `uniq`
+    # and the group numbers follow first-seen order
+    uniq = keys[~norm.duplicated()].reset_index(drop=True)
+
+    # Position in `uniq` for every row of `df`, computed once for all yields
+    row_to_uniq = norm.groupby(key_cols, sort=False).ngroup().to_numpy()
+
+    def _with_codes(codes: list[Optional[str]]) -> pd.DataFrame:
+        return df.assign(**{output_col: np.asarray(codes, dtype=object)[row_to_uniq]})
+
+    codes = []
+    pending = []
+    for i, (name, desc, comp) in enumerate(
+        zip(
+            uniq[name_col].to_numpy(),
+            uniq[desc_col].to_numpy(),
+            uniq[comp_col].to_numpy(),
+        )
+    ):
+        key = cache_key(name, desc, comp)
+        code = _code_cache.get(key)
+        prompt_input = None
+        if code is None:
+            code, prompt_input = _triage(name, desc, comp)
+        codes.append(code)
+        if prompt_input is not None:
+            pending.append((i, key, prompt_input))
+
+    total = len(codes)
+    done = total - len(pending)
+    if on_progress:
+        on_progress(done, total)
+    yield _with_codes(codes)
+
+    # One concurrent pass over everything instead of a round-trip per row
+    since_yield = 0
+    for j, code in _iter_classified([inp for _, _, inp in pending]):
+        i, key, _ = pending[j]
+        codes[i] = code
+        _remember_code(key, code)
+        done += 1
+        if on_progress:
+            on_progress(done, total)
+        since_yield += 1
+        if since_yield == chunk_size:
+            since_yield = 0
+            yield _with_codes(codes)
+
+    if since_yield:
+        yield _with_codes(codes)
 
 
 def add_tullkod_column(
@@ -193,18 +576,12 @@ def add_tullkod_column(
     Returns
     -------
     pd.DataFrame
-        Same dataframe with an extra column `output_col`.
+        New dataframe with an extra column `output_col`; `df` itself is not modified.
     """
-
-    def _classify_row(row: pd.Series) -> str:
-        return classify_product(
-            str(row.get(name_col, "")),
-            str(row.get(desc_col, "")),
-            str(row.get(comp_col, "")),
-        )
-
-    df[output_col] = df.apply(_classify_row, axis=1)
-    return df
+    result = None
+    for result in iter_tullkod_column(df, name_col, desc_col, comp_col, output_col):
+        pass
+    return result
 
 
 def explain_classification(
@@ -217,12 +594,14 @@ def explain_classification(
     Returnerar en kort AI-förklaring (2–4 meningar på svenska) till varför
     given tullkod passar produkten (eller varför koden blev UNKNOWN).
     """
-    return explanation_chain.invoke(
+    # Only the chosen code's branch of the hierarchy, not the whole JSON
+    entry = CODE_INDEX.get(tullkod)
+    return get_chains().explanation.invoke(
         {
-            "json": taric_text,
+            "json": orjson.dumps(entry).decode("utf-8") if entry else "{}",
             "code": tullkod,
-            "name": product_name or "",
-            "desc": product_description or "",
-            "composition": composition or "",
+            "name": _text(product_name),
+            "desc": _text(product_description),
+            "composition": _text(composition),
         }
     )